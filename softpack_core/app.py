@@ -11,6 +11,7 @@ from typing import Any, NoReturn
 import typer
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from singleton_decorator import singleton
 from typer import Typer
 
@@ -58,6 +59,10 @@ class Application:
             allow_headers=["*"],
         )
 
+        # package and environment listings are large and very repetitive,
+        # so compress them for clients that accept it.
+        self.router.add_middleware(GZipMiddleware, minimum_size=1024)
+
     def register_api(self, api: Any) -> None:
         """Register an API with the application.
 
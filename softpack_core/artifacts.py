@@ -7,7 +7,9 @@ LICENSE file in the root directory of this source tree.
 import itertools
 import json
 import shutil
+import sys
 import tempfile
+import threading
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
@@ -41,12 +43,14 @@ class Package(PackageBase):
             Package: A Package with name set, and version set if given name had
                      a version.
         """
-        parts = name.split("@", 2)
+        pkg_name, sep, version = name.partition("@")
 
-        if len(parts) == 2:
-            return Package(name=parts[0], version=parts[1])
+        # the same package names recur across many environments held in
+        # memory, so share a single string for each.
+        if sep and "@" not in version:
+            return Package(name=sys.intern(pkg_name), version=version)
 
-        return Package(name=name)
+        return Package(name=sys.intern(name))
 
 
 @dataclass
@@ -137,11 +141,15 @@ class Artifacts:
             """
             return Artifacts.Object(path=self.path, obj=self.obj[key])
 
-        def spec(self) -> Box:
+        def spec(self, metadata: Optional[Box] = None) -> Box:
             """Get dictionary of the softpack.yml file contents.
 
             Also includes the contents of any README.md file.
 
+            Args:
+                metadata: the already parsed metadata for this artifact, if
+                the caller has it; otherwise it is read from the meta file.
+
             Returns:
                 Box: A boxed dictionary.
             """
@@ -155,9 +163,7 @@ class Artifacts:
             else:
                 info["type"] = Artifacts.built_by_softpack
 
-            info.packages = list(
-                map(lambda p: Package.from_name(p), info.packages)
-            )
+            info.packages = [Package.from_name(p) for p in info.packages]
 
             if Artifacts.module_file in self.obj:
                 info["state"] = State.ready
@@ -168,7 +174,8 @@ class Artifacts:
             else:
                 info["state"] = State.queued
 
-            metadata = self.metadata()
+            if metadata is None:
+                metadata = self.metadata()
 
             info["tags"] = getattr(metadata, "tags", [])
             info["hidden"] = getattr(metadata, "hidden", False)
@@ -245,6 +252,9 @@ class Artifacts:
         """Constructor."""
         self.ldap = LDAP()
         self.settings = app.settings
+        # held while building a new tree from HEAD and committing it, so that
+        # writes from worker threads cannot commit over each other.
+        self.lock = threading.RLock()
 
         credentials = None
         try:
@@ -306,8 +316,31 @@ class Artifacts:
             ]
         )
 
+    def remote_branch_exists(self, branch: str) -> bool:
+        """Check whether the remote has a branch, without cloning it.
+
+        Args:
+            branch: the name of the branch.
+
+        Returns:
+            bool: True if the branch exists in the remote.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            repo = pygit2.init_repository(temp_dir, bare=True)
+            remote = repo.remotes.create(
+                "origin", self.settings.artifacts.repo.url
+            )
+            refs = remote.ls_remotes(callbacks=self.credentials_callback)
+
+        return any(ref["name"] == f"refs/heads/{branch}" for ref in refs)
+
     def create_remote_branch(self, branch: str) -> None:
         """Create a branch in remote if it doesn't exist yet."""
+        # listing the remote's refs is much cheaper than cloning it, and the
+        # branch usually exists already.
+        if self.remote_branch_exists(branch):
+            return
+
         temp_dir = tempfile.TemporaryDirectory()
 
         repo = pygit2.clone_repository(
@@ -454,15 +487,16 @@ class Artifacts:
         Args:
             recipe: the recipe to be created.
         """
-        return self.commit_and_push(
-            self.create_file(
-                Path(self.recipes_root),
-                recipe.name + "-" + recipe.version,
-                yaml.dump(recipe),
-                True,
-            ),
-            "add recipe request",
-        )
+        with self.lock:
+            return self.commit_and_push(
+                self.create_file(
+                    Path(self.recipes_root),
+                    recipe.name + "-" + recipe.version,
+                    yaml.dump(recipe),
+                    True,
+                ),
+                "add recipe request",
+            )
 
     def get_recipe_request(
         self, name: str, version: str
@@ -498,10 +532,23 @@ class Artifacts:
         if not recipeData:
             raise FileNotFoundError("recipe request does not exist")
 
-        return self.commit_and_push(
-            self.remove(Path(self.recipes_root), name + "-" + version),
-            "removed recipe request",
-        )
+        with self.lock:
+            return self.commit_and_push(
+                self.remove(Path(self.recipes_root), name + "-" + version),
+                "removed recipe request",
+            )
+
+    def recipe_requests_id(self) -> Optional[str]:
+        """Get an ID that changes whenever the recipe requests change.
+
+        Returns:
+            Optional[str]: The ID of the recipe requests tree, or None if
+            there have never been any requests.
+        """
+        try:
+            return str(self.tree(self.recipes_root).id)
+        except KeyError:
+            return None
 
     def iter_recipe_requests(self) -> Iterable[RecipeObject]:
         """Iterate over recipe requests."""
@@ -598,6 +645,7 @@ class Artifacts:
         files: List[Tuple[str, Union[str, UploadFile]]],
         new_folder: bool = False,
         overwrite: bool = False,
+        root_tree: Optional[pygit2.Tree] = None,
     ) -> pygit2.Oid:
         """Create one or more files in the artifacts repo.
 
@@ -608,6 +656,8 @@ class Artifacts:
             contents: the contents of the file
             new_folder: if True, create the file's parent folder as well
             overwrite: if True, overwrite the file at the specified path
+            root_tree: the tree to add the files to, if not the tree at HEAD;
+            used to build up several changes for a single commit.
 
         Returns:
             the OID of the new tree structure of the repository
@@ -621,7 +671,8 @@ class Artifacts:
             if not overwrite and tree and file_name in tree:
                 raise FileExistsError("File already exists")
 
-        root_tree = self.repo.head.peel(pygit2.Tree)
+        if root_tree is None:
+            root_tree = self.repo.head.peel(pygit2.Tree)
 
         if new_folder and (full_path not in root_tree or overwrite):
             new_treebuilder = self.repo.TreeBuilder()
@@ -4,6 +4,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import logging
 import re
 from typing import Any, Callable, Iterable, cast
 
@@ -13,6 +14,8 @@ from typing_extensions import Self
 from .app import app
 from .config.models import LDAPConfig
 
+logger = logging.getLogger(__name__)
+
 
 class LDAP:
     """LDAP interface."""
@@ -33,7 +36,7 @@ class LDAP:
             self.ldap = ldap.initialize(self.settings.server)
             self.group_regex = re.compile(self.settings.group.pattern)
         except AttributeError as e:
-            print(f"{__file__}: AttributeError: {e}")
+            logger.debug("AttributeError: %s", e)
 
     def filter_groups(self, groups: Iterable) -> list[str]:
         """Filter groups by exclusion pattern.
@@ -78,7 +81,7 @@ class LDAP:
                         self.initialize()
                 return None
             except AttributeError as e:
-                print(f"{__file__}: AttributeError: {e}")
+                logger.debug("AttributeError: %s", e)
 
         return wrapped_function
 
@@ -101,8 +104,8 @@ class LDAP:
             )
             return sorted(self.filter_groups(map(self.parse_group, groups)))
         except AttributeError as e:
-            print(f"{__file__}: AttributeError: {e}")
+            logger.debug("AttributeError: %s", e)
             return []
         except ldap.SERVER_DOWN as e:
-            print(f"{__file__}: AttributeError: {e}")
+            logger.debug("SERVER_DOWN: %s", e)
             return []
@@ -4,6 +4,7 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import asyncio
 import bisect
 import datetime
 import io
@@ -12,7 +13,7 @@ from dataclasses import dataclass, field
 from pathlib import Path
 from time import time
 from traceback import format_exception_only
-from typing import List, Optional, Tuple, Union, cast
+from typing import ClassVar, Iterable, List, Optional, Tuple, Union, cast
 
 import httpx
 import yaml
@@ -30,6 +31,11 @@ from softpack_core.artifacts import (
 )
 from softpack_core.module import GenerateEnvReadme, ToSoftpackYML
 
+try:
+    from yaml import CSafeDumper as YAMLDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeDumper as YAMLDumper  # type: ignore[assignment]
+
 
 @dataclass
 class CreateEnvironmentSuccess:
@@ -151,6 +157,11 @@ WriteArtifactResponse = Union[
     InvalidInputError,
 ]
 
+BuildStatusResponse = Union[
+    List["BuildStatus"],
+    BuilderError,
+]
+
 
 def validate_tag(tag: str) -> Union[None, InvalidInputError]:
     """If the given tag is invalid, return an error describing why, else None.
@@ -178,15 +189,45 @@ def validate_tag(tag: str) -> Union[None, InvalidInputError]:
     return None
 
 
+def softpack_definition(description: str, packages: Iterable[Package]) -> str:
+    """Return the softpack.yml contents for a description and packages.
+
+    Args:
+        description: the description of the environment.
+        packages: the packages in the environment.
+
+    Returns:
+        str: YAML with the description and a list of name@version strings.
+    """
+    return yaml.dump(
+        dict(
+            description=description,
+            packages=[
+                f"{pkg.name}@{pkg.version}" if pkg.version else pkg.name
+                for pkg in packages
+            ],
+        ),
+        Dumper=YAMLDumper,
+    )
+
+
 class PackageInput(Package):
     """A data class model representing a package."""
 
+    @classmethod
+    def from_package(cls, pkg: Package) -> "PackageInput":
+        """Create a PackageInput object from a Package object.
+
+        Return: a PackageInput object
+        """
+        return cls(name=pkg.name, version=pkg.version)
+
     def to_package(self) -> Package:
         """Create a Package object from a PackageInput object.
 
         Return: a Package object
         """
-        return Package(**vars(self))
+        return Package(name=self.name, version=self.version)
 
 
 @dataclass
@@ -200,21 +241,26 @@ class EnvironmentInput:
     username: Optional[str] = ""
     tags: Optional[list[str]] = None
 
+    valid_dirs: ClassVar[frozenset[str]] = frozenset(
+        (Artifacts.users_folder_name, Artifacts.groups_folder_name)
+    )
+
     def validate(self) -> Union[None, InvalidInputError]:
         """Validate all values.
 
+        Checks the path is under a users or groups folder.
         Checks all values have been supplied.
         Checks that name consists only of alphanumerics, dash, and underscore.
 
         Returns:
             None if good, or InvalidInputError if not all values supplied.
         """
-        if any(
-            len(value) == 0
-            for key, value in vars(self).items()
-            if key != "tags"
-            and key != "username"
-            and key != "__pydantic_initialised__"
+        top_dir, sep, _ = self.path.partition("/")
+        if not sep or top_dir not in self.valid_dirs:
+            return InvalidInputError(error="Invalid path")
+
+        if not (
+            self.name and self.path and self.description and self.packages
         ):
             return InvalidInputError(error="all fields must be filled in")
 
@@ -224,13 +270,6 @@ class EnvironmentInput:
                 "dash, and underscore"
             )
 
-        valid_dirs = [
-            Artifacts.users_folder_name,
-            Artifacts.groups_folder_name,
-        ]
-        if not any(self.path.startswith(dir + "/") for dir in valid_dirs):
-            return InvalidInputError(error="Invalid path")
-
         if not re.fullmatch(r"^[^/]+/[a-zA-Z0-9_-]+$", self.path):
             return InvalidInputError(
                 error="user/group subdirectory must only contain "
@@ -269,7 +308,7 @@ class EnvironmentInput:
         return any(pkg.name.startswith("*") for pkg in self.packages)
 
 
-@dataclass
+@dataclass(slots=True)
 class BuildStatus:
     """A class representing the status of a build."""
 
@@ -278,15 +317,78 @@ class BuildStatus:
     build_start: Optional[datetime.datetime]
     build_done: Optional[datetime.datetime]
 
+    pending: ClassVar[Optional["asyncio.Future[BuildStatusResponse]"]] = None
+    client: ClassVar[Optional[httpx.AsyncClient]] = None
+    client_loop: ClassVar[Optional[asyncio.AbstractEventLoop]] = None
+
     @classmethod
-    def get_all(cls) -> Union[List["BuildStatus"], BuilderError]:
-        """Get all known environment build statuses."""
-        try:
+    async def get_all(cls) -> BuildStatusResponse:
+        """Get all known environment build statuses.
+
+        Callers that arrive while a request to the builder is already in
+        flight share its result instead of making their own request.
+        """
+        loop = asyncio.get_running_loop()
+        pending = cls.pending
+
+        if pending is None or pending.get_loop() is not loop:
+            pending = asyncio.ensure_future(cls.fetch_all())
+            pending.add_done_callback(cls.clear_pending)
+            cls.pending = pending
+
+        return await asyncio.shield(pending)
+
+    @classmethod
+    def clear_pending(cls, fut: "asyncio.Future[BuildStatusResponse]") -> None:
+        """Forget a finished builder request so the next caller makes one."""
+        if cls.pending is fut:
+            cls.pending = None
+
+    @classmethod
+    def builder_client(cls) -> httpx.AsyncClient:
+        """Get the client used to talk to the builder.
+
+        The client, and so its pool of kept-alive connections, is reused
+        between requests, but is recreated if the event loop has changed
+        as its connections can't be used from a different loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        if cls.client is None or cls.client_loop is not loop:
+            old_client, old_loop = cls.client, cls.client_loop
+
             host = app.settings.builder.host
             port = app.settings.builder.port
-            r = httpx.get(
-                f"http://{host}:{port}/environments/status",
-            )
+            cls.client = httpx.AsyncClient(base_url=f"http://{host}:{port}")
+            cls.client_loop = loop
+
+            # the old client's connections belong to its loop, so they can
+            # only be closed there, and only while it is running; otherwise
+            # the client is just dropped.
+            if (
+                old_client is not None
+                and old_loop is not None
+                and old_loop.is_running()
+            ):
+                asyncio.run_coroutine_threadsafe(old_client.aclose(), old_loop)
+
+        return cls.client
+
+    @classmethod
+    async def close_client(cls) -> None:
+        """Close the client used to talk to the builder, if there is one."""
+        client = cls.client
+        cls.client = None
+        cls.client_loop = None
+
+        if client is not None:
+            await client.aclose()
+
+    @classmethod
+    async def fetch_all(cls) -> BuildStatusResponse:
+        """Request all known environment build statuses from the builder."""
+        try:
+            r = await cls.builder_client().get("/environments/status")
             r.raise_for_status()
             json = r.json()
         except Exception as e:
@@ -355,6 +457,10 @@ class Environment:
     interpreters: Interpreters = field(default_factory=Interpreters)
 
     environments: list["Environment"] = field(default_factory=list)
+    requested_recipes: ClassVar[
+        dict[tuple[str, Optional[str]], set[Path]]
+    ] = dict()
+    states: ClassVar[dict[Optional[State], set[Path]]] = dict()
 
     @classmethod
     def init(cls, branch: str | None) -> None:
@@ -372,6 +478,11 @@ class Environment:
 
         cls.environments.sort(key=lambda x: x.full_path())
 
+        cls.requested_recipes = dict()
+        cls.states = dict()
+        for env in cls.environments:
+            cls.index_environment(env)
+
     def full_path(cls) -> Path:
         """Return a Path containing the file path and name."""
         return Path(cls.path, cls.name)
@@ -385,6 +496,97 @@ class Environment:
         """Do any of the requested packages have an unmade recipe."""
         return any(pkg.name.startswith("*") for pkg in self.packages)
 
+    def to_input(self) -> EnvironmentInput:
+        """Create an EnvironmentInput, for the builder, from this environment.
+
+        The packages are copied, so the input can be modified without
+        affecting the cached environment.
+
+        Return: an EnvironmentInput object
+        """
+        return EnvironmentInput(
+            name=self.name,
+            path=self.path,
+            description=self.description,
+            packages=[PackageInput.from_package(pkg) for pkg in self.packages],
+        )
+
+    @classmethod
+    def index_environment(cls, env: "Environment", add: bool = True) -> None:
+        """Add an environment to, or remove it from, the lookup indexes.
+
+        The indexes are of environments by state and by the recipe requests
+        they use.
+
+        Args:
+            env: the environment to index.
+            add: True to add the environment, False to remove it.
+        """
+        path = env.full_path()
+        keys: list[tuple[dict, object]] = [(cls.states, env.state)]
+
+        for pkg in env.packages:
+            if pkg.name.startswith("*"):
+                keys.append(
+                    (cls.requested_recipes, (pkg.name[1:], pkg.version))
+                )
+
+        for index, key in keys:
+            if add:
+                index.setdefault(key, set()).add(path)
+            elif key in index:
+                index[key].discard(path)
+
+                if not index[key]:
+                    del index[key]
+
+    @classmethod
+    def from_paths(cls, paths: Iterable[Path]) -> list["Environment"]:
+        """Return the cached environments at the given paths, in path order.
+
+        Args:
+            paths: the full paths of the environments.
+
+        Returns:
+            list[Environment]: The environments.
+        """
+        envs = []
+
+        for path in sorted(paths):
+            index = cls.env_index_from_path(str(path))
+
+            if index is not None:
+                envs.append(cls.environments[index])
+
+        return envs
+
+    @classmethod
+    def requesting_recipe(
+        cls, name: str, version: Optional[str]
+    ) -> list["Environment"]:
+        """Return the environments that use the given requested recipe.
+
+        Args:
+            name: the name of the requested recipe, without the leading *.
+            version: the version of the requested recipe.
+
+        Returns:
+            list[Environment]: The environments, in path order.
+        """
+        return cls.from_paths(cls.requested_recipes.get((name, version), ()))
+
+    @classmethod
+    def in_state(cls, state: State) -> list["Environment"]:
+        """Return the environments that are in the given state.
+
+        Args:
+            state: the state to look for.
+
+        Returns:
+            list[Environment]: The environments, in path order.
+        """
+        return cls.from_paths(cls.states.get(state, ()))
+
     @classmethod
     def get_env(cls, path: Path, name: str) -> Optional["Environment"]:
         """Return an Environment object given a path.
@@ -412,10 +614,12 @@ class Environment:
             Environment: An Environment object.
         """
         try:
-            spec = obj.spec()
-            if spec.force_hidden:
+            metadata = obj.metadata()
+            if metadata.get("force_hidden", False):
                 return None
 
+            spec = obj.spec(metadata)
+
             return Environment(
                 name=obj.name,
                 path=str(obj.path.parent),
@@ -451,12 +655,14 @@ class Environment:
                 error="environment name must not be blank"
             )
 
-        while not isinstance(
-            cls.check_env_exists(
-                Path(env.path, env.name + "-" + str(version))
-            ),
-            EnvironmentNotFoundError,
-        ):
+        existing = {
+            folder.name
+            for folder in artifacts.iter_environments(
+                artifacts.environments_folder(env.path)
+            )
+        }
+
+        while env.name + "-" + str(version) in existing:
             version += 1
 
         if version != 1:
@@ -469,12 +675,13 @@ class Environment:
             ):
                 version -= 1
 
-                tree_oid = artifacts.delete_environment(
-                    env.name + "-" + str(version), env.path
-                )
-                artifacts.commit_and_push(
-                    tree_oid, "remove failed environment"
-                )
+                with artifacts.lock:
+                    tree_oid = artifacts.delete_environment(
+                        env.name + "-" + str(version), env.path
+                    )
+                    artifacts.commit_and_push(
+                        tree_oid, "remove failed environment"
+                    )
 
         env.name += "-" + str(version)
         response = cls.create_new_env(env, Artifacts.built_by_softpack_file)
@@ -497,6 +704,7 @@ class Environment:
         bisect.insort(
             Environment.environments, env, key=lambda x: x.full_path()
         )
+        Environment.index_environment(env)
 
     @classmethod
     def submit_env_to_builder(
@@ -581,14 +789,7 @@ class Environment:
         # Create folder with initial files
         new_folder_path = Path(env.path, env.name)
         try:
-            softpack_definition = dict(
-                description=env.description,
-                packages=[
-                    pkg.name + ("@" + pkg.version if pkg.version else "")
-                    for pkg in env.packages
-                ],
-            )
-            definitionData = yaml.dump(softpack_definition)
+            definitionData = softpack_definition(env.description, env.packages)
 
             meta = dict(
                 tags=sorted(set(env.tags or [])),
@@ -598,22 +799,25 @@ class Environment:
             if env.username != "" and env.username is not None:
                 meta["username"] = env.username
 
-            metaData = yaml.dump(meta)
-
-            tree_oid = artifacts.create_files(
-                Path(artifacts.environments_root, new_folder_path),
-                [
-                    (env_type, ""),  # e.g. .built_by_softpack
-                    (
-                        artifacts.environments_file,
-                        definitionData,
-                    ),  # softpack.yml
-                    (artifacts.meta_file, metaData),
-                ],
-                True,
-                True,
-            )
-            artifacts.commit_and_push(tree_oid, "create environment folder")
+            metaData = yaml.dump(meta, Dumper=YAMLDumper)
+
+            with artifacts.lock:
+                tree_oid = artifacts.create_files(
+                    Path(artifacts.environments_root, new_folder_path),
+                    [
+                        (env_type, ""),  # e.g. .built_by_softpack
+                        (
+                            artifacts.environments_file,
+                            definitionData,
+                        ),  # softpack.yml
+                        (artifacts.meta_file, metaData),
+                    ],
+                    True,
+                    True,
+                )
+                artifacts.commit_and_push(
+                    tree_oid, "create environment folder"
+                )
         except RuntimeError as e:
             return InvalidInputError(
                 error="".join(format_exception_only(type(e), e))
@@ -674,13 +878,12 @@ class Environment:
         tree = artifacts.get(Path(path), name)
         if tree is None:
             return EnvironmentNotFoundError(path=path, name=name)
-        box = tree.spec()
-        tags = set(box.tags)
+        metadata = tree.metadata()
+        tags = set(metadata.get("tags") or [])
         if tag in tags:
             return AddTagSuccess(message="Tag already present")
         tags.add(tag)
 
-        metadata = cls.read_metadata(path, name)
         metadata.tags = sorted(tags)
 
         metadataResponse = await cls.store_metadata(environment_path, metadata)
@@ -772,8 +975,9 @@ class Environment:
             A message confirming the success or failure of the operation.
         """
         if artifacts.get(Path(path), name):
-            tree_oid = artifacts.delete_environment(name, path)
-            artifacts.commit_and_push(tree_oid, "delete environment")
+            with artifacts.lock:
+                tree_oid = artifacts.delete_environment(name, path)
+                artifacts.commit_and_push(tree_oid, "delete environment")
 
             Environment.update_cache(Path(path, name))
 
@@ -817,8 +1021,10 @@ class Environment:
         """
         env = EnvironmentInput.from_path(environment_path)
 
-        response = cls.create_new_env(
-            env, Artifacts.generated_from_module_file
+        # creating the environment takes the artifacts lock and pushes, so
+        # keep it off the event loop.
+        response = await asyncio.to_thread(
+            cls.create_new_env, env, Artifacts.generated_from_module_file
         )
         if not isinstance(response, CreateEnvironmentSuccess):
             return response
@@ -828,7 +1034,9 @@ class Environment:
         )
 
         if not isinstance(result, WriteArtifactSuccess):
-            cls.delete(name=env.name, path=environment_path)
+            await asyncio.to_thread(
+                cls.delete, name=env.name, path=environment_path
+            )
             return InvalidInputError(
                 error="Write of module file failed: " + result.error
             )
@@ -933,26 +1141,65 @@ class Environment:
             files: the files to add to the repo.
             commitMsg: the msg for the commit.
         """
-        try:
-            new_files: List[Tuple[str, Union[str, UploadFile]]] = []
-            for file in files:
-                if isinstance(file, tuple):
-                    new_files.append(
-                        cast(Tuple[str, Union[str, UploadFile]], file)
-                    )
-                else:
-                    new_files.append(
-                        (file.filename or "", cast(UploadFile, file))
-                    )
+        return await cls.write_many_artifacts(
+            [(folder_path, files)], commitMsg
+        )
 
-            tree_oid = artifacts.create_files(
-                Path(artifacts.environments_root, folder_path),
-                new_files,
-                overwrite=True,
-            )
-            artifacts.commit_and_push(tree_oid, commitMsg)
+    @classmethod
+    async def write_many_artifacts(
+        cls,
+        writes: list[Tuple[str, list[Union[UploadFile, Tuple[str, str]]]]],
+        commitMsg: str = "write artifact",
+    ) -> WriteArtifactResponse:  # type: ignore
+        """Add files to one or more folders of the Artifacts repo.
+
+        All of the files are added in a single commit.
 
-            Environment.update_cache(folder_path)
+        Args:
+            writes: pairs of the path to a folder and the files to add to it.
+            commitMsg: the msg for the commit.
+        """
+        try:
+            new_writes: list[
+                Tuple[str, List[Tuple[str, Union[str, UploadFile]]]]
+            ] = []
+            for folder_path, files in writes:
+                new_files: List[Tuple[str, Union[str, UploadFile]]] = []
+                for file in files:
+                    if isinstance(file, tuple):
+                        new_files.append(
+                            cast(Tuple[str, Union[str, UploadFile]], file)
+                        )
+                    else:
+                        new_files.append(
+                            (file.filename or "", cast(UploadFile, file))
+                        )
+
+                new_writes.append((folder_path, new_files))
+
+            if not new_writes:
+                raise ValueError("No artifacts to write")
+
+            def write() -> None:
+                with artifacts.lock:
+                    root_tree = None
+                    for folder_path, new_files in new_writes:
+                        tree_oid = artifacts.create_files(
+                            Path(artifacts.environments_root, folder_path),
+                            new_files,
+                            overwrite=True,
+                            root_tree=root_tree,
+                        )
+                        root_tree = artifacts.repo.get(tree_oid)
+
+                    artifacts.commit_and_push(tree_oid, commitMsg)
+
+            # building the tree and pushing are blocking disk and network
+            # operations, so keep them off the event loop.
+            await asyncio.to_thread(write)
+
+            for folder_path, _ in new_writes:
+                Environment.update_cache(folder_path)
 
             return WriteArtifactSuccess(
                 message="Successfully written artifact(s)",
@@ -972,23 +1219,37 @@ class Environment:
         if index is None:
             if env:
                 Environment.insert_new_env(env)
-        elif env:
-            Environment.environments[index] = env
         else:
-            del Environment.environments[index]
+            Environment.index_environment(
+                Environment.environments[index], add=False
+            )
+
+            if env:
+                Environment.environments[index] = env
+                Environment.index_environment(env)
+            else:
+                del Environment.environments[index]
 
     @classmethod
     def env_index_from_path(cls, folder_path: str) -> Optional[int]:
-        """Return the index of a folder_path from the list of environments."""
-        return next(
-            (
-                i
-                for i, env in enumerate(Environment.environments)
-                if str(env.full_path()) == folder_path
-            ),
-            None,
+        """Return the index of a folder_path from the list of environments.
+
+        The environments list is kept sorted by full_path, so this is a
+        binary search rather than a scan.
+        """
+        path = Path(folder_path)
+        index = bisect.bisect_left(
+            Environment.environments, path, key=lambda x: x.full_path()
         )
 
+        if (
+            index < len(Environment.environments)
+            and Environment.environments[index].full_path() == path
+        ):
+            return index
+
+        return None
+
     @classmethod
     async def update_from_module(
         cls, file: bytes, module_path: str, environment_path: str
@@ -1015,12 +1276,12 @@ class Environment:
         Returns:
             A message confirming the success or failure of the operation.
         """
-        env = EnvironmentInput.from_path(environment_path)
-
         result = cls.check_env_exists(Path(environment_path))
         if result is not None:
             return result
 
+        env = EnvironmentInput.from_path(environment_path)
+
         convertResult = await cls.convert_module_file_to_artifacts(
             file, env.name, environment_path, module_path
         )
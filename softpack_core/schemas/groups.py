@@ -5,26 +5,33 @@ LICENSE file in the root directory of this source tree.
 """
 
 from dataclasses import dataclass
-from typing import Iterable
+from typing import ClassVar, Optional
 
 from ..ldapapi import LDAP
 
 
-@dataclass
+@dataclass(slots=True)
 class Group:
     """A data class representing a single unix group."""
 
     name: str
 
+    ldap: ClassVar[Optional[LDAP]] = None
+
     @classmethod
-    def from_username(cls, username: str) -> Iterable["Group"]:
+    def from_username(cls, username: str) -> list["Group"]:
         """Get the groups the given user belongs to.
 
         Args:
             username: Their usernamer.
 
         Returns:
-            Iterable: An iterator over unix group names.
+            list[Group]: The user's unix groups.
         """
-        groups = LDAP().groups(username)
-        return (Group(name=group) for group in groups)
+        # reuse one client (and so one connection) for all lookups; LDAP
+        # reconnects by itself if the server goes away.
+        if cls.ldap is None:
+            cls.ldap = LDAP()
+
+        groups = cls.ldap.groups(username) or []
+        return [Group(name=group) for group in groups]
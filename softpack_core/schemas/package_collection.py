@@ -32,8 +32,10 @@ class PackageCollection:
             objects.
         """
         if app.spack.packagesUpdated:
-            cls.packages = list(map(cls.from_package, app.spack.packages()))
+            # clear the flag first so that a refresh by the update timer
+            # while we rebuild is picked up by the next call.
             app.spack.packagesUpdated = False
+            cls.packages = list(map(cls.from_package, app.spack.packages()))
 
         return cls.packages
 
@@ -5,17 +5,20 @@ LICENSE file in the root directory of this source tree.
 """
 
 
+import asyncio
+import concurrent.futures
+import datetime
 import smtplib
-import statistics
+import threading
+import time
 import urllib.parse
 from email.mime.text import MIMEText
 from pathlib import Path
-from typing import Tuple, Union, cast
+from typing import Optional, Tuple, Union, cast
 
 import typer
 import uvicorn
-import yaml
-from fastapi import APIRouter, Request, Response, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Request, Response, UploadFile
 from typer import Typer
 from typing_extensions import Annotated
 
@@ -26,12 +29,13 @@ from softpack_core.schemas.environment import (
     BuilderError,
     BuildStatus,
     CreateEnvironmentSuccess,
+    CreateResponse,
     DelEnvironmentInput,
     Environment,
     EnvironmentInput,
-    PackageInput,
     SetHiddenInput,
     WriteArtifactSuccess,
+    softpack_definition,
 )
 from softpack_core.schemas.groups import Group
 from softpack_core.schemas.package_collection import PackageCollection
@@ -39,6 +43,44 @@ from softpack_core.schemas.package_collection import PackageCollection
 from .api import API
 from .app import app
 
+# the line spack writes to the build log when concretization fails.
+CONCRETIZATION_FAILED = b"concretization failed for the following reasons:"
+
+# subject and message template of the email sent when a build finishes,
+# keyed by the environment's failure reason (None for a successful build).
+BUILD_EMAILS: dict[Optional[str], tuple[str, str]] = {
+    None: (
+        "Your SoftPack environment is ready!",
+        "Hi {username},\n"
+        "\n"
+        "Your environment, {env_path}, has built successfully.\n"
+        "\n"
+        "SoftPack Team",
+    ),
+    "build": (
+        "Your SoftPack environment failed to build",
+        "Hi {username},\n"
+        "\n"
+        "Your environment, {env_path}, has failed to build.\n"
+        "\n"
+        "The error was a build error. "
+        "Contact your softpack administrator.\n"
+        "\n"
+        "SoftPack Team",
+    ),
+    "concretization": (
+        "Your SoftPack environment failed to build",
+        "Hi {username},\n"
+        "\n"
+        "Your environment, {env_path}, has failed to build.\n"
+        "\n"
+        "The error was a version conflict. "
+        "Try relaxing which versions you've specified.\n"
+        "\n"
+        "SoftPack Team",
+    ),
+}
+
 
 class ServiceAPI(API):
     """Service module."""
@@ -76,7 +118,6 @@ class ServiceAPI(API):
         """
         if branch != 'main':
             print(f'Changing branch to {branch}')
-            # FIXME do only when branch does not exist
             artifacts.create_remote_branch(branch)
 
         Environment.init(branch)
@@ -89,11 +130,18 @@ class ServiceAPI(API):
             log_level="debug",
         )
 
+    @staticmethod
+    @router.on_event("shutdown")
+    async def close_builder_client() -> None:
+        """Close the kept-alive connections to the builder."""
+        await BuildStatus.close_client()
+
     @staticmethod
     @router.post("/upload")
     async def upload_artifacts(  # type: ignore[no-untyped-def]
         request: Request,
         file: list[UploadFile],
+        background_tasks: BackgroundTasks,
     ):
         """upload_artifacts is a POST fn that adds files to an environment.
 
@@ -103,51 +151,60 @@ class ServiceAPI(API):
             file (List[UploadFile]): The files to be uploaded.
             request (Request): The POST request which contains the environment
             path in the query.
+            background_tasks (BackgroundTasks): Tasks, such as sending emails,
+            to run after the response has been sent.
 
         Returns:
             WriteArtifactResponse
         """
         env_path = urllib.parse.unquote(request.url.query)
-        if Environment.check_env_exists(Path(env_path)) is not None:
-            create_response = Environment.create_new_env(
-                EnvironmentInput.from_path(env_path),
-                artifacts.built_by_softpack_file,
-            )
+        path = Path(env_path)
 
-            if not isinstance(create_response, CreateEnvironmentSuccess):
-                return create_response
+        def create_if_missing() -> Optional[CreateResponse]:
+            # hold the lock so that concurrent uploads for the same new
+            # environment can't both try to create it.
+            with artifacts.lock:
+                if Environment.check_env_exists(path) is None:
+                    return None
 
-        path = Path(env_path)
-        env = Environment.get_env(path.parent, path.name)
+                return Environment.create_new_env(
+                    EnvironmentInput.from_path(env_path),
+                    artifacts.built_by_softpack_file,
+                )
+
+        # reading and writing the artifacts repo blocks, so do it off the
+        # event loop.
+        create_response = await asyncio.to_thread(create_if_missing)
+        if create_response is not None and not isinstance(
+            create_response, CreateEnvironmentSuccess
+        ):
+            return create_response
+
+        env = await asyncio.to_thread(
+            Environment.get_env, path.parent, path.name
+        )
         newState = State.queued
         files = cast(list[Union[UploadFile, Tuple[str, str]]], file)
 
         if env:
-            for i in range(len(file)):
-                f = file[i]
-                if f.filename == artifacts.builder_out:
-                    newState = State.failed
-
-                    contents = cast(str, (await f.read()).decode())
-
-                    if (
-                        "concretization failed for the following reasons:"
-                        in contents
-                    ):
-                        await env.update_metadata(
-                            "failure_reason", "concretization"
-                        )
-                        env.failure_reason = "concretization"
-                    else:
-                        await env.update_metadata("failure_reason", "build")
-                        env.failure_reason = "build"
-
-                    files[i] = (f.filename, contents)
-
-                if f.filename == artifacts.module_file:
-                    newState = State.ready
-
-                    break
+            uploaded = {f.filename: f for f in file}
+            builder_out = uploaded.get(artifacts.builder_out)
+
+            # a module means the build succeeded, whatever else was uploaded
+            # with it.
+            if artifacts.module_file in uploaded:
+                newState = State.ready
+            elif builder_out is not None:
+                newState = State.failed
+
+                if await file_contains(builder_out, CONCRETIZATION_FAILED):
+                    await env.update_metadata(
+                        "failure_reason", "concretization"
+                    )
+                    env.failure_reason = "concretization"
+                else:
+                    await env.update_metadata("failure_reason", "build")
+                    env.failure_reason = "build"
 
             if (
                 newState != State.queued
@@ -155,38 +212,17 @@ class ServiceAPI(API):
                 and env.username != ""
             ):
                 envEmailConfig = app.settings.environments
-                m = (
-                    "built sucessfully"
+                subject, template = (
+                    BUILD_EMAILS[None]
                     if newState == State.ready
-                    else "failed to build"
+                    else BUILD_EMAILS[env.failure_reason]
                 )
-
-                e = (
-                    ""
-                    if newState == State.ready
-                    else "\nThe error was a build error. "
-                    + "Contact your softpack administrator.\n"
-                    if env.failure_reason == "build"
-                    else "\nThe error was a version conflict. "
-                    + "Try relaxing which versions you've specified.\n"
-                )
-
-                message = (
-                    f"Hi {env.username},\n"
-                    + "\n"
-                    + f"Your environment, {env_path}, has {m}.\n"
-                    + e
-                    + "\n"
-                    + "SoftPack Team"
+                message = template.format(
+                    username=env.username, env_path=env_path
                 )
 
-                subject = (
-                    "Your SoftPack environment is ready!"
-                    if newState == State.ready
-                    else "Your SoftPack environment failed to build"
-                )
-
-                send_email(
+                background_tasks.add_task(
+                    send_email_async,
                     envEmailConfig,
                     message,
                     subject,
@@ -207,26 +243,27 @@ class ServiceAPI(API):
         response: Response,
     ):
         """Resubmit any pending builds to the builder."""
-        successes = 0
-        failures = 0
+        # submissions are blocking requests to the builder, so make them
+        # from threads, a limited number at a time.
+        limit = asyncio.Semaphore(16)
+
+        async def submit(env: Environment) -> bool:
+            async with limit:
+                result = await asyncio.to_thread(
+                    Environment.submit_env_to_builder, env.to_input()
+                )
 
-        for env in Environment.iter():
-            if env.state != State.queued:
-                continue
+            return result is None
 
-            result = Environment.submit_env_to_builder(
-                EnvironmentInput(
-                    name=env.name,
-                    path=env.path,
-                    description=env.description,
-                    packages=[PackageInput(**vars(p)) for p in env.packages],
-                )
-            )
+        results = await asyncio.gather(
+            *(submit(env) for env in Environment.in_state(State.queued)),
+            return_exceptions=True,
+        )
 
-            if result is None:
-                successes += 1
-            else:
-                failures += 1
+        # an unexpected error for one environment counts as a failed resend,
+        # rather than abandoning the results for all of the others.
+        successes = sum(result is True for result in results)
+        failures = len(results) - successes
 
         if failures == 0:
             message = "Successfully triggered resends"
@@ -244,6 +281,7 @@ class ServiceAPI(API):
     @router.post("/request-recipe")
     async def request_recipe(  # type: ignore[no-untyped-def]
         request: Request,
+        background_tasks: BackgroundTasks,
     ):
         """Request a recipe to be created."""
         data = await request.json()
@@ -253,14 +291,17 @@ class ServiceAPI(API):
                 return {"error": "Invalid Input"}
 
         try:
-            artifacts.create_recipe_request(
+            # this takes the artifacts lock and pushes, so run it off the
+            # event loop.
+            await asyncio.to_thread(
+                artifacts.create_recipe_request,
                 Artifacts.RecipeObject(
                     data["name"],
                     data["version"],
                     data["description"],
                     data["url"],
                     data["username"],
-                )
+                ),
             )
         except Exception as e:
             return {"error": str(e)}
@@ -268,7 +309,8 @@ class ServiceAPI(API):
         if data["username"] != "":
             recipeConfig = app.settings.recipes
 
-            send_email(
+            background_tasks.add_task(
+                send_email_async,
                 recipeConfig,
                 f'User: {data["username"]}\n'
                 + f'Recipe: {data["name"]}\n'
@@ -285,8 +327,24 @@ class ServiceAPI(API):
     @router.get("/requested-recipes")
     async def requested_recipes(  # type: ignore[no-untyped-def]
         request: Request,
+        response: Response,
     ):
-        """List requested recipes."""
+        """List requested recipes.
+
+        The response has an ETag, so clients polling for changes can make
+        conditional requests and get an empty 304 response if nothing has
+        changed.
+        """
+        recipes_id = artifacts.recipe_requests_id()
+
+        if recipes_id is not None:
+            etag = f'"{recipes_id}"'
+
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+
+            response.headers["ETag"] = etag
+
         return list(artifacts.iter_recipe_requests())
 
     @staticmethod
@@ -305,21 +363,25 @@ class ServiceAPI(API):
             data["requestedName"], data["requestedVersion"]
         )
 
-        if r is None or not any(
-            version == data["version"]
-            for pkg in app.spack.stored_packages
-            if pkg.name == data["name"]
-            for version in pkg.versions
+        if r is None or not app.spack.has_version(
+            data["name"], data["version"]
         ):
             return {"error": "Unknown Recipe"}
 
-        for env in Environment.iter():
+        newEnvs: list[EnvironmentInput] = []
+
+        for env in Environment.requesting_recipe(
+            data["requestedName"], data["requestedVersion"]
+        ):
             if env.state != State.waiting:
                 continue
 
-            changed = False
+            # work on a copy, so the cached environment (and the recipe
+            # request index built from it) is left untouched until it is
+            # reloaded from the written artifacts.
+            newEnv = env.to_input()
 
-            for pkg in env.packages:
+            for pkg in newEnv.packages:
                 if (
                     pkg.name.startswith("*")
                     and pkg.name[1:] == data["requestedName"]
@@ -327,51 +389,44 @@ class ServiceAPI(API):
                 ):
                     pkg.name = data["name"]
                     pkg.version = data["version"]
-                    changed = True
 
                     break
 
-            if not changed:
-                continue
+            newEnvs.append(newEnv)
 
-            await Environment.write_artifacts(
-                str(Path(env.path, env.name)),
+        if newEnvs:
+            # write all of the updated environments in a single commit.
+            result = await Environment.write_many_artifacts(
                 [
                     (
-                        Artifacts.environments_file,
-                        yaml.dump(
-                            dict(
-                                description=env.description,
-                                packages=[
-                                    pkg.name
-                                    + (
-                                        "@" + pkg.version
-                                        if pkg.version
-                                        else ""
-                                    )
-                                    for pkg in env.packages
-                                ],
+                        str(Path(newEnv.path, newEnv.name)),
+                        [
+                            (
+                                Artifacts.environments_file,
+                                softpack_definition(
+                                    newEnv.description, newEnv.packages
+                                ),
                             )
-                        ),
+                        ],
                     )
+                    for newEnv in newEnvs
                 ],
-                "fulfil recipe request for environment",
+                "fulfil recipe request for environments",
             )
 
-            if not env.has_requested_recipes():
-                Environment.submit_env_to_builder(
-                    EnvironmentInput(
-                        name=env.name,
-                        path=env.path,
-                        description=env.description,
-                        packages=[
-                            PackageInput(**vars(p)) for p in env.packages
-                        ],
-                    )
-                )
+            # nothing was written, so leave the request in place for the
+            # environments still relying on it.
+            if not isinstance(result, WriteArtifactSuccess):
+                return result
 
-        artifacts.remove_recipe_request(
-            data["requestedName"], data["requestedVersion"]
+        for newEnv in newEnvs:
+            if not newEnv.has_requested_recipes():
+                Environment.submit_env_to_builder(newEnv)
+
+        await asyncio.to_thread(
+            artifacts.remove_recipe_request,
+            data["requestedName"],
+            data["requestedVersion"],
         )
 
         return {"message": "Recipe Fulfilled"}
@@ -388,20 +443,16 @@ class ServiceAPI(API):
             if not isinstance(data[key], str):
                 return {"error": "Invalid Input"}
 
-        for env in Environment.iter():
-            for pkg in env.packages:
-                if (
-                    pkg.name.startswith("*")
-                    and pkg.name[1:] == data["name"]
-                    and pkg.version == data["version"]
-                ):
-                    return {
-                        "error": "There are environments relying on this "
-                        + "requested recipe; can not delete."
-                    }
+        if Environment.requesting_recipe(data["name"], data["version"]):
+            return {
+                "error": "There are environments relying on this "
+                + "requested recipe; can not delete."
+            }
 
         try:
-            artifacts.remove_recipe_request(data["name"], data["version"])
+            await asyncio.to_thread(
+                artifacts.remove_recipe_request, data["name"], data["version"]
+            )
         except Exception as e:
             return {"error": e}
 
@@ -429,25 +480,25 @@ class ServiceAPI(API):
         request: Request,
     ):
         """Return the avg wait seconds and a map of names to build status."""
-        statuses = BuildStatus.get_all()
+        statuses = await BuildStatus.get_all()
         if isinstance(statuses, BuilderError):
             statuses = []
 
-        try:
-            avg_wait_secs = statistics.mean(
-                (s.build_done - s.requested).total_seconds()
-                for s in statuses
-                if s.build_done is not None
-            )
-        except statistics.StatisticsError:
-            avg_wait_secs = None
+        total_wait_secs = 0.0
+        builds_done = 0
+        build_starts: dict[str, datetime.datetime] = {}
+
+        for s in statuses:
+            if s.build_done is not None:
+                total_wait_secs += (s.build_done - s.requested).total_seconds()
+                builds_done += 1
+
+            if s.build_start is not None:
+                build_starts[s.name] = s.build_start
 
         return {
-            "avg": avg_wait_secs,
-            "statuses": map(
-                lambda x: (x.name, x.build_start),
-                filter(lambda x: x.build_start is not None, statuses),
-            ),
+            "avg": total_wait_secs / builds_done if builds_done else None,
+            "statuses": build_starts,
         }
 
     @staticmethod
@@ -531,7 +582,161 @@ class ServiceAPI(API):
         if not isinstance(username, str):
             return {"error": "invalid username"}
 
-        return (group.name for group in Group.from_username(username))
+        return [group.name for group in Group.from_username(username)]
+
+
+async def file_contains(
+    file: UploadFile, needle: bytes, chunk_size: int = 65536
+) -> bool:
+    """Search an uploaded file for the given bytes without buffering it all.
+
+    The file is read in chunks, keeping enough of the previous chunk to
+    match a needle that straddles a chunk boundary, and is rewound
+    afterwards so that it can still be written to the artifacts repo.
+
+    Args:
+        file: the uploaded file to search.
+        needle: the bytes to look for.
+        chunk_size: the number of bytes to read at a time.
+
+    Returns:
+        bool: True if the needle was found in the file.
+    """
+    overlap = len(needle) - 1
+    tail = b""
+    found = False
+
+    while chunk := await file.read(chunk_size):
+        buf = tail + chunk
+
+        if needle in buf:
+            found = True
+
+            break
+
+        tail = buf[-overlap:] if overlap > 0 else b""
+
+    await file.seek(0)
+
+    return found
+
+
+class SMTPPool:
+    """A pool of open SMTP connections, kept per server and local hostname."""
+
+    max_idle = 5
+    max_idle_secs = 60
+    max_messages = 100
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.lock = threading.Lock()
+        self.idle: dict[
+            tuple[str, Optional[str]], list[tuple[smtplib.SMTP, int, float]]
+        ] = {}
+
+    def sendmail(
+        self,
+        host: str,
+        local_hostname: Optional[str],
+        fromAddr: str,
+        toAddrs: list[str],
+        msg: str,
+    ) -> None:
+        """Send a message using a pooled connection to the given server.
+
+        Args:
+            host: the SMTP server to connect to.
+            local_hostname: the hostname to give to the server, if any.
+            fromAddr: the envelope sender.
+            toAddrs: the envelope recipients.
+            msg: the message to send.
+        """
+        key = (host, local_hostname)
+        conn, sent = self.get(key)
+
+        try:
+            conn.sendmail(fromAddr, toAddrs, msg)
+        except Exception:
+            self.close(conn)
+            raise
+
+        self.put(key, conn, sent + 1)
+
+    def get(self, key: tuple[str, Optional[str]]) -> tuple[smtplib.SMTP, int]:
+        """Get a live connection for the key, opening one if needed.
+
+        Returns:
+            tuple[smtplib.SMTP, int]: The connection and the number of
+            messages already sent over it.
+        """
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    break
+
+                conn, sent, idle_since = idle.pop()
+
+            # servers drop connections that have been idle for a while, so
+            # don't spend a round trip checking one that likely has been.
+            if time.monotonic() - idle_since > self.max_idle_secs:
+                self.close(conn)
+                continue
+
+            try:
+                conn.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close(conn)
+                continue
+
+            return conn, sent
+
+        host, local_hostname = key
+
+        return smtplib.SMTP(host, local_hostname=local_hostname), 0
+
+    def put(
+        self, key: tuple[str, Optional[str]], conn: smtplib.SMTP, sent: int
+    ) -> None:
+        """Return a connection to the pool, or close it if it is not wanted.
+
+        Any connections for the key that have been idle for too long are
+        closed at the same time.
+        """
+        now = time.monotonic()
+        stale = []
+
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+
+            while idle and now - idle[0][2] > self.max_idle_secs:
+                stale.append(idle.pop(0)[0])
+
+            if sent < self.max_messages and len(idle) < self.max_idle:
+                idle.append((conn, sent, now))
+            else:
+                stale.append(conn)
+
+        for old in stale:
+            self.close(old)
+
+    @staticmethod
+    def close(conn: smtplib.SMTP) -> None:
+        """Close a connection, ignoring any errors from a dead server."""
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+
+smtp_pool = SMTPPool()
+
+# emails are sent on their own threads so that a slow mail server can't tie
+# up the default executor used for writing artifacts.
+mail_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SMTPPool.max_idle, thread_name_prefix="send_email"
+)
 
 
 def send_email(
@@ -563,12 +768,34 @@ def send_email(
     if emailConfig.localHostname is not None:
         localhostname = emailConfig.localHostname
 
-    s = smtplib.SMTP(emailConfig.smtp, local_hostname=localhostname)
-    s.sendmail(
+    smtp_pool.sendmail(
+        emailConfig.smtp,
+        localhostname,
         fromAddr,
         [toAddr, emailConfig.adminAddr]
         if sendAdmin and emailConfig.adminAddr is not None
         else [toAddr],
         msg.as_string(),
     )
-    s.quit()
+
+
+async def send_email_async(
+    emailConfig: EmailConfig,
+    message: str,
+    subject: str,
+    username: str,
+    sendAdmin: bool = True,
+) -> None:
+    """Send an email from the mail threads, without blocking the event loop.
+
+    Takes the same arguments as send_email.
+    """
+    await asyncio.get_running_loop().run_in_executor(
+        mail_executor,
+        send_email,
+        emailConfig,
+        message,
+        subject,
+        username,
+        sendAdmin,
+    )
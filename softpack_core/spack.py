@@ -4,13 +4,18 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import concurrent.futures
+import hashlib
+import html
+import re
+import shutil
+import string
 import subprocess
 import tempfile
 import threading
 from dataclasses import dataclass
-from html.parser import HTMLParser
-from os import path
-from typing import Tuple
+from os import cpu_count, listdir, path, replace
+from typing import Optional, Tuple
 
 
 @dataclass
@@ -27,62 +32,60 @@ class Package(PackageBase):
     versions: list[str]
 
 
-class SpackHTMLParser(HTMLParser):
-    """Class to parse HTML output from `spack list --format=html`."""
+class SpackHTMLParser:
+    """Class to parse HTML output from `spack list --format=html`.
+
+    The output is machine generated and regular, so rather than walking every
+    character with html.parser, the few elements of interest are picked out
+    with a single compiled regex pass.
+    """
+
+    tokens = re.compile(
+        rb'<div\s[^>]*?\bid="([^"]*)"'
+        rb"|<dt>(Versions|Description):</dt>\s*<dd>([^<]*)"
+    )
 
     def __init__(self) -> None:
         """Init class."""
-        super().__init__()
-
-        self.onDT = False
-        self.onDD = True
-        self.nextIsVersion = False
-        self.nextIsDescription = False
         self.recipe = ""
 
         self.versions: list[Package] = list()
         self.descriptions: dict[str, str] = dict()
 
-    def handle_starttag(
-        self, tag: str, attrs: list[tuple[str, str | None]]
-    ) -> None:
-        """Handle open tags."""
-        if tag == "div":
-            self.recipe = next(
-                attr[1]
-                for attr in attrs
-                if attr[0] == "id" and isinstance(attr[1], str)
-            )
-        elif tag == "dt":
-            self.onDT = True
-        elif tag == "dd":
-            self.onDD = True
-
-    def handle_data(self, data: str) -> None:
-        """Handle data."""
-        if self.onDT:
-            self.onDT = False
-            self.nextIsVersion = data == "Versions:"
-            self.nextIsDescription = data == "Description:"
-        elif self.onDD:
-            self.onDD = False
-
-            if self.nextIsVersion:
-                self.nextIsVersion = False
+        # Many packages share version strings such as "1.0" or "develop", so
+        # store a single copy of each.
+        self.version_strings: dict[str, str] = dict()
+
+    def feed(self, data: bytes) -> None:
+        """Parse spack HTML output, collecting versions and descriptions."""
+        for match in self.tokens.finditer(data):
+            recipe, field, value = match.groups()
+
+            if recipe is not None:
+                self.recipe = html.unescape(recipe.decode("utf-8"))
+            elif field == b"Versions":
+                versions = html.unescape(value.decode("utf-8"))
+
                 self.versions.append(
                     Package(
-                        name=self.recipe, versions=data.strip().split(", ")
+                        name=self.recipe,
+                        versions=[
+                            self.version_strings.setdefault(version, version)
+                            for version in versions.strip().split(", ")
+                        ],
                     )
                 )
-            elif self.nextIsDescription:
-                self.nextIsDescription = False
-                self.descriptions[self.recipe] = data.strip()
+            else:
+                self.descriptions[self.recipe] = html.unescape(
+                    value.decode("utf-8")
+                ).strip()
 
 
 class Spack:
     """Spack interface class."""
 
     packagesUpdated: bool = True
+    list_shards = ["[!a-z]*"] + [c + "*" for c in string.ascii_lowercase]
 
     def __init__(
         self,
@@ -93,31 +96,69 @@ class Spack:
         """Constructor."""
         self.stored_packages: list[Package] = []
         self.descriptions: dict[str, str] = dict()
+        self.versions_by_name: dict[str, set[str]] = dict()
+        self.packages_digest = b""
+        self.custom_repo_head: Optional[str] = None
         self.checkout_path = ""
+        self.checkout_lock = threading.Lock()
+        self.tmp_dir: Optional[tempfile.TemporaryDirectory[str]] = None
+        self.timer: Optional[threading.Timer] = None
         self.spack_exe = spack_exe
         self.cacheDir = cache
         self.custom_repo = custom_repo
 
-    def load_package_list(self, spack_exe: str, custom_repo: str) -> None:
-        """Load a list of all packages."""
-        checkout_path = ""
+    def load_package_list(self, spack_exe: str, custom_repo: str) -> bool:
+        """Load a list of all packages.
+
+        Returns:
+            bool: True if the list came from spack, False if from the cache.
+        """
+        if custom_repo == "":
+            return self.store_packages_from_spack(spack_exe, "")
 
-        if custom_repo != "":
-            tmp_dir = tempfile.TemporaryDirectory()
-            checkout_path = tmp_dir.name
-            self.checkout_custom_repo(custom_repo, checkout_path)
+        with self.checkout_lock:
+            if self.checkout_path == "":
+                if self.cacheDir != "":
+                    self.checkout_path = path.join(self.cacheDir, "repo")
+                else:
+                    self.tmp_dir = tempfile.TemporaryDirectory()
+                    self.checkout_path = self.tmp_dir.name
 
-        self.store_packages_from_spack(spack_exe, checkout_path)
+            self.checkout_custom_repo(custom_repo, self.checkout_path)
+
+            return self.store_packages_from_spack(
+                spack_exe, self.checkout_path
+            )
 
     def checkout_custom_repo(
         self, custom_repo: str, checkout_path: str
     ) -> None:
         """Clones the custom spack package repo to a local path.
 
+        If the path already holds a clone, it is updated in place instead.
+
         Args:
             custom_repo (str): URL to custom spack package repo.
             checkout_path (str): Path to clone custom spack repo to.
         """
+        if path.isdir(path.join(checkout_path, ".git")):
+            try:
+                for cmd in (
+                    ["fetch", "--depth", "1", custom_repo, "HEAD"],
+                    ["reset", "--hard", "FETCH_HEAD"],
+                ):
+                    subprocess.run(
+                        ["git", "-C", checkout_path] + cmd,
+                        capture_output=True,
+                    ).check_returncode()
+
+                return
+            except subprocess.CalledProcessError:
+                shutil.rmtree(checkout_path)
+        elif path.isdir(checkout_path) and listdir(checkout_path):
+            # left behind by an interrupted clone; git won't clone into it.
+            shutil.rmtree(checkout_path)
+
         result = subprocess.run(
             ["git", "clone", "--depth", "1", custom_repo, checkout_path],
             capture_output=True,
@@ -127,28 +168,58 @@ class Spack:
 
     def store_packages_from_spack(
         self, spack_exe: str, checkout_path: str
-    ) -> None:
+    ) -> bool:
         """Reads the full list of available packages in spack and stores them.
 
         Args:
             spack_exe (str): Path to the spack executable.
             checkout_path (str): Path to the cloned custom spack repo.
+
+        Returns:
+            bool: True if spack was run, False if the on-disk cache was read.
         """
         htmlData, didReadFromCache = self.__readPackagesFromCacheOnce()
 
         if not didReadFromCache:
             htmlData = self.__getPackagesFromSpack(spack_exe, checkout_path)
 
+        # spack's output rarely changes between updates, and parsing it is
+        # slow, so there's nothing to do if it is the same as last time.
+        digest = hashlib.sha256(htmlData).digest()
+        if digest == self.packages_digest:
+            return not didReadFromCache
+
+        if not didReadFromCache:
             self.__writeToCache(htmlData)
 
         shp = SpackHTMLParser()
 
-        shp.feed(htmlData.decode("utf-8"))
+        shp.feed(htmlData)
 
-        self.stored_packages = shp.versions
-        self.descriptions = shp.descriptions
+        self.store_packages(shp.versions, shp.descriptions)
+        self.packages_digest = digest
         self.packagesUpdated = True
 
+        return not didReadFromCache
+
+    def store_packages(
+        self, packages: list[Package], descriptions: dict[str, str]
+    ) -> None:
+        """Replace the stored packages, and the version index built from them.
+
+        Args:
+            packages (list[Package]): The spack packages.
+            descriptions (dict[str, str]): Package descriptions, by name.
+        """
+        versions_by_name: dict[str, set[str]] = dict()
+
+        for pkg in packages:
+            versions_by_name.setdefault(pkg.name, set()).update(pkg.versions)
+
+        self.stored_packages = packages
+        self.descriptions = descriptions
+        self.versions_by_name = versions_by_name
+
     def __readPackagesFromCacheOnce(self) -> Tuple[bytes, bool]:
         if len(self.stored_packages) > 0 or self.cacheDir == "":
             return (b"", False)
@@ -165,9 +236,15 @@ class Spack:
         if self.cacheDir == "":
             return
 
-        with open(path.join(self.cacheDir, "pkgs"), "wb") as f:
+        cache = path.join(self.cacheDir, "pkgs")
+
+        # write to a temporary file and move it into place, so that a reader
+        # never sees, and a crash never leaves behind, a partial cache.
+        with open(cache + ".tmp", "wb") as f:
             f.write(jsonData)
 
+        replace(cache + ".tmp", cache)
+
     def packages(self) -> list[Package]:
         """Returns the list of stored packages.
 
@@ -181,10 +258,51 @@ class Spack:
 
         return self.stored_packages
 
+    def has_version(self, name: str, version: str) -> bool:
+        """Check whether a version of a package is in the stored packages.
+
+        Args:
+            name (str): Name of the package.
+            version (str): Version of the package.
+
+        Returns:
+            bool: True if spack knows of that version of the package.
+        """
+        return version in self.versions_by_name.get(name, ())
+
+    def remote_custom_repo_head(self) -> Optional[str]:
+        """Get the commit ID of the custom repo HEAD, without cloning it.
+
+        Returns:
+            Optional[str]: The commit ID, or None if there is no custom repo.
+        """
+        if self.custom_repo == "":
+            return None
+
+        result = subprocess.run(
+            ["git", "ls-remote", self.custom_repo, "HEAD"],
+            capture_output=True,
+            timeout=10,
+        )
+
+        result.check_returncode()
+
+        return result.stdout.split(maxsplit=1)[0].decode()
+
     def keep_packages_updated(self, interval: float) -> None:
         """Runs package list retireval on a timer."""
         try:
-            self.load_package_list(self.spack_exe, self.custom_repo)
+            head = self.remote_custom_repo_head()
+
+            if (
+                head is None
+                or head != self.custom_repo_head
+                or len(self.stored_packages) == 0
+            ):
+                # a list read from the cache may predate the current HEAD,
+                # so only a real spack run lets later ticks be skipped.
+                if self.load_package_list(self.spack_exe, self.custom_repo):
+                    self.custom_repo_head = head
         except Exception:
             pass
 
@@ -198,28 +316,29 @@ class Spack:
         """Stops any running timer threads."""
         if self.timer is not None:
             self.timer.cancel()
+            self.timer = None
 
     def __getPackagesFromSpack(
         self, spack_exe: str, checkout_path: str
     ) -> bytes:
-        if checkout_path == "":
-            result = subprocess.run(
-                [spack_exe, "list", "--format", "html"],
-                capture_output=True,
-            )
+        cmd = [spack_exe, "list", "--format", "html"]
 
-            return result.stdout
+        if checkout_path != "":
+            cmd[1:1] = ["--config", "repos:[" + checkout_path + "]"]
 
-        result = subprocess.run(
-            [
-                spack_exe,
-                "--config",
-                "repos:[" + checkout_path + "]",
-                "list",
-                "--format",
-                "html",
-            ],
-            capture_output=True,
-        )
+        # spack spends most of its time loading each package in turn, so
+        # split the listing by first letter and run the parts in parallel.
+        # The parts are concatenated in order; each carries its own header
+        # section, which the parser ignores. If any part fails, the whole
+        # listing is abandoned rather than dropping that part's packages.
+        def list_shard(shard: str) -> bytes:
+            result = subprocess.run(cmd + [shard], capture_output=True)
+
+            result.check_returncode()
+
+            return result.stdout
 
-        return result.stdout
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(self.list_shards), cpu_count() or 1)
+        ) as executor:
+            return b"".join(executor.map(list_shard, self.list_shards))
@@ -368,6 +368,37 @@ async def test_write_artifact(httpx_post, testable_env_input):
     assert isinstance(result, InvalidInputError)
 
 
+@pytest.mark.asyncio
+async def test_write_many_artifacts(httpx_post, testable_env_input):
+    orig_name = testable_env_input.name
+    for _ in range(2):
+        result = Environment.create(testable_env_input)
+        testable_env_input.name = orig_name
+        assert isinstance(result, CreateEnvironmentSuccess)
+
+    folders = [
+        f"{testable_env_input.path}/{testable_env_input.name}-{n}"
+        for n in (1, 2)
+    ]
+    head = artifacts.repo.head.target
+
+    result = await Environment.write_many_artifacts(
+        [(folder, [("example.txt", folder)]) for folder in folders]
+    )
+    assert isinstance(result, WriteArtifactSuccess)
+
+    commit = artifacts.repo.head.peel(pygit2.Commit)
+    assert commit.parent_ids == [head]
+
+    for folder in folders:
+        path = Path(artifacts.environments_root, folder, "example.txt")
+        assert file_in_remote(path)
+        assert commit.tree[str(path)].data.decode() == folder
+
+    result = await Environment.write_many_artifacts([])
+    assert isinstance(result, InvalidInputError)
+
+
 @pytest.mark.asyncio
 async def test_email_on_build_complete(
     httpx_post, send_email, testable_env_input
@@ -399,7 +430,7 @@ async def test_email_on_build_complete(
     assert send_email.call_count == 1
 
     assert send_email.call_args[0][0] == app.settings.environments
-    assert "built sucessfully" in send_email.call_args[0][1]
+    assert "built successfully" in send_email.call_args[0][1]
     assert "The error was" not in send_email.call_args[0][1]
     assert send_email.call_args[0][2] == "Your SoftPack environment is ready!"
     assert send_email.call_args[0][3] == "me"
@@ -549,6 +580,8 @@ def test_iter(testable_env_input):
     assert len(envs) == 2
     assert envs[0].state == State.queued
     assert envs[1].state == State.queued
+    assert Environment.in_state(State.queued) == envs
+    assert Environment.in_state(State.ready) == []
 
 
 @pytest.mark.asyncio
@@ -607,6 +640,8 @@ async def test_states(httpx_post, testable_env_input, mocker):
     env = get_env_from_iter(testable_env_input.name + "-1")
     assert env is not None
     assert env.state == State.failed
+    assert env in Environment.in_state(State.failed)
+    assert env not in Environment.in_state(State.queued)
 
     upload = UploadFile(
         filename=Artifacts.module_file, file=io.BytesIO(b"#%Module")
@@ -623,6 +658,8 @@ async def test_states(httpx_post, testable_env_input, mocker):
     assert env is not None
     assert env.type == Artifacts.built_by_softpack
     assert env.state == State.ready
+    assert env in Environment.in_state(State.ready)
+    assert env not in Environment.in_state(State.failed)
 
 
 def get_env_from_iter(name: str) -> Optional[Environment]:
@@ -750,6 +787,28 @@ def test_environmentinput_from_path():
         assert EnvironmentInput.from_path(path).validate() is not None
 
 
+def test_environmentinput_validate_errors():
+    env = EnvironmentInput.from_path("users/any1/envName")
+
+    env.path = ""
+    assert env.validate() == InvalidInputError(error="Invalid path")
+
+    env.path = "others/any1"
+    assert env.validate() == InvalidInputError(error="Invalid path")
+
+    env.path = "users/any1"
+    env.description = ""
+    assert env.validate() == InvalidInputError(
+        error="all fields must be filled in"
+    )
+
+    env.description = "description"
+    env.name = "bad!"
+    assert env.validate() == InvalidInputError(
+        error="name must only contain alphanumerics, dash, and underscore"
+    )
+
+
 @pytest.mark.asyncio
 async def test_tagging(
     httpx_post, testable_env_input: EnvironmentInput
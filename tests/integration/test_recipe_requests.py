@@ -13,6 +13,7 @@ from softpack_core.schemas.environment import (
     CreateEnvironmentSuccess,
     Environment,
     EnvironmentInput,
+    InvalidInputError,
     PackageInput,
 )
 from softpack_core.spack import Package
@@ -21,7 +22,7 @@ from tests.integration.utils import builder_called_correctly
 pytestmark = pytest.mark.repo
 
 
-def test_request_recipe(httpx_post, testable_env_input, send_email):
+def test_request_recipe(httpx_post, testable_env_input, send_email, mocker):
     app.settings.recipes = EmailConfig(
         fromAddr="{}@domain.com",
         toAddr="hgi@domain.com",
@@ -63,6 +64,15 @@ def test_request_recipe(httpx_post, testable_env_input, send_email):
         }
     ]
 
+    etag = resp.headers["etag"]
+
+    resp = client.get(
+        url="/requested-recipes", headers={"If-None-Match": etag}
+    )
+
+    assert resp.status_code == 304
+    assert resp.content == b""
+
     resp = client.post(
         url="/request-recipe",
         json={
@@ -120,6 +130,7 @@ def test_request_recipe(httpx_post, testable_env_input, send_email):
             "username": "me2",
         },
     ]
+    assert resp.headers["etag"] != etag
 
     env = EnvironmentInput.from_path("users/me/my_env-1")
     env.packages = [
@@ -142,8 +153,10 @@ def test_request_recipe(httpx_post, testable_env_input, send_email):
 
     httpx_post.assert_not_called()
 
-    app.spack.stored_packages.append(
-        Package(name="finalRecipe", versions=["1.2.1"])
+    packages = app.spack.stored_packages
+    app.spack.store_packages(
+        packages + [Package(name="finalRecipe", versions=["1.2.1"])],
+        app.spack.descriptions,
     )
 
     try:
@@ -251,6 +264,33 @@ def test_request_recipe(httpx_post, testable_env_input, send_email):
 
         assert resp.json() == {"error": "Unknown Recipe"}
 
+        write_many_artifacts = Environment.write_many_artifacts
+        write_mock = mocker.patch.object(
+            Environment,
+            "write_many_artifacts",
+            return_value=InvalidInputError(error="push failed"),
+        )
+
+        resp = client.post(
+            url="/fulfil-requested-recipe",
+            json={
+                "name": "finalRecipe",
+                "version": "1.2.1",
+                "requestedName": "c_recipe",
+                "requestedVersion": "0.9",
+            },
+        )
+
+        assert resp.json() == {"error": "push failed"}
+        assert write_mock.call_count == 1
+        httpx_post.assert_called_once()
+
+        resp = client.get(url="/requested-recipes")
+
+        assert [recipe["name"] for recipe in resp.json()] == ["c_recipe"]
+
+        write_mock.side_effect = write_many_artifacts
+
         resp = client.post(
             url="/fulfil-requested-recipe",
             json={
@@ -263,4 +303,4 @@ def test_request_recipe(httpx_post, testable_env_input, send_email):
 
         assert resp.json() == {"message": "Recipe Fulfilled"}
     finally:
-        app.spack.stored_packages.pop()
+        app.spack.store_packages(packages, app.spack.descriptions)
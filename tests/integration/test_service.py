@@ -4,19 +4,29 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import asyncio
+import io
 import multiprocessing
+import smtplib
 from pathlib import Path
 from time import sleep
 
 import httpx
+import pytest
 from box import Box
+from fastapi import UploadFile
 from fastapi.testclient import TestClient
 
 from softpack_core import __version__
 from softpack_core.app import app
 from softpack_core.config.models import EmailConfig
-from softpack_core.schemas.environment import EnvironmentInput
-from softpack_core.service import ServiceAPI, send_email
+from softpack_core.schemas.environment import BuildStatus, EnvironmentInput
+from softpack_core.service import (
+    ServiceAPI,
+    SMTPPool,
+    file_contains,
+    send_email,
+)
 
 
 def test_service_run() -> None:
@@ -38,6 +48,7 @@ def test_service_run() -> None:
 def test_send_email(mocker):
     mock_SMTP = mocker.MagicMock(name="smtplib.SMTP")
     mocker.patch("smtplib.SMTP", new=mock_SMTP)
+    mocker.patch("softpack_core.service.smtp_pool", new=SMTPPool())
 
     emailConfig = EmailConfig(
         fromAddr="test@domain.com",
@@ -83,6 +94,8 @@ def test_send_email(mocker):
 
     send_email(emailConfig, "MESSAGE2", "SUBJECT2", "USERNAME2", False)
     assert mock_SMTP.return_value.sendmail.call_count == 3
+    assert mock_SMTP.call_count == 2
+    assert mock_SMTP.return_value.noop.call_count == 1
     assert mock_SMTP.return_value.sendmail.call_args[0][1] == [
         "USERNAME2@other-domain.com"
     ]
@@ -96,8 +109,58 @@ def test_send_email(mocker):
     assert mock_SMTP.return_value.sendmail.call_count == 3
 
 
+def test_smtp_pool_reconnects(mocker):
+    mock_SMTP = mocker.MagicMock(name="smtplib.SMTP")
+    mocker.patch("smtplib.SMTP", new=mock_SMTP)
+    pool = SMTPPool()
+
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    assert mock_SMTP.call_count == 1
+
+    mock_SMTP.return_value.noop.side_effect = smtplib.SMTPServerDisconnected
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    assert mock_SMTP.call_count == 2
+    assert mock_SMTP.return_value.sendmail.call_count == 2
+
+    mock_SMTP.return_value.noop.side_effect = None
+    pool.max_messages = 3
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    assert mock_SMTP.call_count == 2
+    assert pool.idle[("host.mail.com", None)] == []
+
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    assert mock_SMTP.call_count == 3
+    noops = mock_SMTP.return_value.noop.call_count
+
+    pool.max_idle_secs = -1
+    pool.sendmail("host.mail.com", None, "a@b.com", ["c@d.com"], "MSG")
+    assert mock_SMTP.call_count == 4
+    assert mock_SMTP.return_value.noop.call_count == noops
+
+
+@pytest.mark.asyncio
+async def test_file_contains():
+    needle = b"concretization failed"
+    data = b"x" * 10 + needle + b"y" * 10
+
+    for chunk_size in (1, 4, 15, 100):
+        f = UploadFile(filename="builder.out", file=io.BytesIO(data))
+
+        assert await file_contains(f, needle, chunk_size)
+        assert await f.read() == data
+
+    f = UploadFile(filename="builder.out", file=io.BytesIO(b"x" * 100))
+
+    assert not await file_contains(f, needle, 8)
+    assert await f.read() == b"x" * 100
+
+
 def test_build_status(mocker):
-    get_mock = mocker.patch("httpx.get")
+    get_mock = mocker.patch(
+        "httpx.AsyncClient.get", new_callable=mocker.AsyncMock
+    )
+    get_mock.return_value = mocker.MagicMock()
     get_mock.return_value.json.return_value = [
         {
             "Name": "users/test_user/test_environment",
@@ -142,6 +205,61 @@ def test_build_status(mocker):
     }
 
 
+@pytest.mark.asyncio
+async def test_build_status_shared(mocker):
+    get_mock = mocker.patch(
+        "httpx.AsyncClient.get", new_callable=mocker.AsyncMock
+    )
+    get_mock.return_value = mocker.MagicMock()
+    get_mock.return_value.json.return_value = []
+
+    statuses = await asyncio.gather(
+        BuildStatus.get_all(), BuildStatus.get_all()
+    )
+
+    assert statuses == [[], []]
+    get_mock.assert_awaited_once()
+
+    assert await BuildStatus.get_all() == []
+    assert get_mock.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_build_status_client_reused(mocker):
+    mocker.patch.object(BuildStatus, "client", None)
+    mocker.patch.object(BuildStatus, "client_loop", None)
+
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json=[])
+
+    clients = []
+    AsyncClient = httpx.AsyncClient
+
+    def new_client(**kwargs) -> httpx.AsyncClient:
+        clients.append(
+            AsyncClient(transport=httpx.MockTransport(handler), **kwargs)
+        )
+        return clients[-1]
+
+    mocker.patch("httpx.AsyncClient", side_effect=new_client)
+
+    assert await BuildStatus.get_all() == []
+    assert await BuildStatus.get_all() == []
+
+    assert len(requests) == 2
+    assert len(clients) == 1
+    assert requests[0].url.host == app.settings.builder.host
+    assert requests[0].url.path == "/environments/status"
+
+    await BuildStatus.close_client()
+
+    assert clients[0].is_closed
+    assert BuildStatus.client is None
+
+
 def test_create_env(httpx_post, testable_env_input: EnvironmentInput):
     client = TestClient(app.router)
     input = testable_env_input.__dict__
@@ -241,7 +359,11 @@ def test_upload_and_update_module(testable_env_input: EnvironmentInput):
 def test_package_collection():
     client = TestClient(app.router)
 
-    resp = client.get("/package-collection")
+    resp = client.get(
+        "/package-collection", headers={"Accept-Encoding": "gzip"}
+    )
+
+    assert resp.headers["content-encoding"] == "gzip"
 
     pkgs = resp.json()
 
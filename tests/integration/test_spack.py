@@ -4,6 +4,8 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import shutil
+import subprocess
 import time
 
 import pytest
@@ -13,7 +15,238 @@ from softpack_core.schemas.package_collection import (
     PackageCollection,
     PackageMultiVersion,
 )
-from softpack_core.spack import Package, Spack
+from softpack_core.spack import Package, Spack, SpackHTMLParser
+
+
+def test_spack_has_version():
+    spack = Spack()
+    spack.store_packages(
+        [
+            Package(name="pkg", versions=["1", "2"]),
+            Package(name="other", versions=["3"]),
+        ],
+        {},
+    )
+
+    assert spack.has_version("pkg", "2")
+    assert not spack.has_version("pkg", "3")
+    assert not spack.has_version("missing", "1")
+
+    spack.store_packages(
+        spack.stored_packages + [Package(name="missing", versions=["1"])], {}
+    )
+
+    assert spack.has_version("missing", "1")
+
+
+def test_spack_package_updater_refreshes_cached_list(mocker, tmp_path):
+    html = b'<div id="pkg"><dl><dt>Versions:</dt><dd>1, 2</dd></dl></div>'
+    (tmp_path / "pkgs").write_bytes(html)
+
+    mocker.patch(
+        "subprocess.run",
+        return_value=mocker.Mock(stdout=b"0123abcd\tHEAD\n"),
+    )
+    mocker.patch.object(Spack, "checkout_custom_repo")
+    get_packages = mocker.patch.object(
+        Spack,
+        "_Spack__getPackagesFromSpack",
+        return_value=html.replace(b"1, 2", b"1, 2, 3"),
+    )
+    mocker.patch("threading.Timer")
+
+    spack = Spack(custom_repo="https://example.com/repo", cache=str(tmp_path))
+
+    spack.keep_packages_updated(1)
+
+    assert get_packages.call_count == 0
+    assert spack.stored_packages[0].versions == ["1", "2"]
+
+    spack.keep_packages_updated(1)
+
+    assert get_packages.call_count == 1
+    assert spack.stored_packages[0].versions == ["1", "2", "3"]
+
+    spack.keep_packages_updated(1)
+
+    assert get_packages.call_count == 1
+
+
+def test_spack_html_parser():
+    shp = SpackHTMLParser()
+    shp.feed(
+        b'<div class="section" id="zlib">\n<dl class="docutils">\n'
+        b"<dt>Homepage:</dt>\n<dd><ul><li>https://zlib.net</li></ul>\n</dd>\n"
+        b"<dt>Versions:</dt>\n<dd>\n1.3, 1.2.13\n</dd>\n"
+        b"<dt>Description:</dt>\n<dd>\n  A &quot;lossless&quot; library.\n"
+        b"</dd>\n</dl>\n</div>\n"
+    )
+
+    assert shp.versions == [Package(name="zlib", versions=["1.3", "1.2.13"])]
+    assert shp.descriptions == {"zlib": 'A "lossless" library.'}
+
+
+def test_spack_unchanged_packages_not_reparsed(mocker):
+    html = b'<div id="pkg"><dl><dt>Versions:</dt><dd>1, 2</dd></dl></div>'
+    get_packages = mocker.patch.object(
+        Spack, "_Spack__getPackagesFromSpack", return_value=html
+    )
+
+    spack = Spack()
+    spack.store_packages_from_spack("spack", "")
+
+    assert spack.packagesUpdated
+    assert spack.stored_packages == [Package(name="pkg", versions=["1", "2"])]
+
+    pkgs = spack.stored_packages
+    spack.packagesUpdated = False
+    spack.store_packages_from_spack("spack", "")
+
+    assert get_packages.call_count == 2
+    assert not spack.packagesUpdated
+    assert spack.stored_packages is pkgs
+
+    get_packages.return_value = html.replace(b"1, 2", b"1, 2, 3")
+    spack.store_packages_from_spack("spack", "")
+
+    assert spack.packagesUpdated
+    assert spack.stored_packages[0].versions == ["1", "2", "3"]
+
+
+def test_spack_list_sharded(mocker):
+    def run(cmd, capture_output):
+        return subprocess.CompletedProcess(cmd, 0, stdout=cmd[-1].encode())
+
+    run_mock = mocker.patch("subprocess.run", side_effect=run)
+
+    spack = Spack()
+    html = spack._Spack__getPackagesFromSpack("spack", "/repo")
+
+    assert html == "".join(Spack.list_shards).encode()
+    assert run_mock.call_count == len(Spack.list_shards)
+    assert [
+        "spack",
+        "--config",
+        "repos:[/repo]",
+        "list",
+        "--format",
+        "html",
+        "[!a-z]*",
+    ] in [call.args[0] for call in run_mock.call_args_list]
+
+
+def test_spack_stop_package_timer():
+    spack = Spack()
+    spack.stop_package_timer()
+
+    assert spack.timer is None
+
+
+def test_spack_list_shard_failure(mocker, tmp_path):
+    def run(cmd, capture_output):
+        return subprocess.CompletedProcess(
+            cmd, int(cmd[-1] == "m*"), stdout=cmd[-1].encode()
+        )
+
+    mocker.patch("subprocess.run", side_effect=run)
+
+    spack = Spack(cache=str(tmp_path))
+
+    with pytest.raises(subprocess.CalledProcessError):
+        spack.store_packages_from_spack("spack", "")
+
+    assert spack.stored_packages == []
+    assert not (tmp_path / "pkgs").exists()
+
+
+def test_spack_package_updater_skips_unchanged_repo(mocker):
+    head = b"0123abcd\tHEAD\n"
+    run_mock = mocker.patch(
+        "subprocess.run", return_value=mocker.Mock(stdout=head)
+    )
+
+    def load_package_list(*_):
+        spack.stored_packages = [Package(name="pkg", versions=["1"])]
+
+        return True
+
+    load_mock = mocker.patch.object(
+        Spack, "load_package_list", side_effect=load_package_list
+    )
+    mocker.patch("threading.Timer")
+
+    spack = Spack(custom_repo="https://example.com/repo")
+
+    spack.keep_packages_updated(1)
+    spack.keep_packages_updated(1)
+
+    assert load_mock.call_count == 1
+    assert run_mock.call_args.args[0] == [
+        "git",
+        "ls-remote",
+        "https://example.com/repo",
+        "HEAD",
+    ]
+
+    run_mock.return_value.stdout = head.replace(b"0123", b"4567")
+    spack.keep_packages_updated(1)
+
+    assert load_mock.call_count == 2
+
+
+def test_spack_custom_repo_checkout_reused(tmp_path):
+    repo = tmp_path / "repo"
+    checkout = tmp_path / "checkout"
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-C", str(repo), "-c", "user.name=a", "-c", "user.email=a"]
+            + list(args),
+            check=True,
+        )
+
+    repo.mkdir()
+    git("init", "-q")
+    (repo / "file").write_text("1")
+    git("add", "file")
+    git("commit", "-qm", "1")
+
+    spack = Spack()
+    spack.checkout_custom_repo(repo.as_uri(), str(checkout))
+
+    assert (checkout / "file").read_text() == "1"
+
+    (repo / "file").write_text("2")
+    git("commit", "-qam", "2")
+
+    (checkout / "marker").touch()
+    spack.checkout_custom_repo(repo.as_uri(), str(checkout))
+
+    assert (checkout / "file").read_text() == "2"
+    assert (checkout / "marker").exists()
+
+    shutil.rmtree(checkout / ".git")
+    spack.checkout_custom_repo(repo.as_uri(), str(checkout))
+
+    assert (checkout / "file").read_text() == "2"
+    assert not (checkout / "marker").exists()
+
+
+def test_spack_cache_written_atomically(mocker, tmp_path):
+    html = b'<div id="pkg"><dl><dt>Versions:</dt><dd>1, 2</dd></dl></div>'
+    mocker.patch.object(
+        Spack, "_Spack__getPackagesFromSpack", return_value=html
+    )
+
+    Spack(cache=str(tmp_path)).store_packages_from_spack("spack", "")
+
+    assert [p.name for p in tmp_path.iterdir()] == ["pkgs"]
+    assert (tmp_path / "pkgs").read_bytes() == html
+
+    spack = Spack(cache=str(tmp_path))
+    spack.store_packages_from_spack("spack", "")
+
+    assert spack.stored_packages == [Package(name="pkg", versions=["1", "2"])]
 
 
 def test_spack_packages():
@@ -4,9 +4,10 @@ This source code is licensed under the MIT license found in the
 LICENSE file in the root directory of this source tree.
 """
 
+import shutil
 import tempfile
 from pathlib import Path
-from typing import Union
+from typing import Union, cast
 
 import pygit2
 import pytest
@@ -20,6 +21,11 @@ artifacts_dict = dict[
 ]
 
 
+# clones of the test branch in its initial test state, by branch name; made
+# once per session and copied for each test, instead of re-cloning.
+test_repo_templates: dict[str, artifacts_dict] = {}
+
+
 def new_test_artifacts() -> artifacts_dict:
     branch_name = app.settings.artifacts.repo.branch
 
@@ -31,12 +37,36 @@ def new_test_artifacts() -> artifacts_dict:
             )
         )
 
+    template = test_repo_templates.get(branch_name)
+    if template is None:
+        template_dir = tempfile.TemporaryDirectory()
+        app.settings.artifacts.path = Path(template_dir.name)
+        artifacts.create_remote_branch(branch_name)
+        artifacts.clone_repo(branch_name)
+
+        template = reset_test_repo(artifacts)
+        template["temp_dir"] = template_dir
+        test_repo_templates[branch_name] = template
+
+    template_path = Path(
+        cast(tempfile.TemporaryDirectory[str], template["temp_dir"]).name
+    )
     temp_dir = tempfile.TemporaryDirectory()
     app.settings.artifacts.path = Path(temp_dir.name)
-    artifacts.create_remote_branch(branch_name)
-    artifacts.clone_repo(branch_name)
+    shutil.copytree(template_path, temp_dir.name, dirs_exist_ok=True)
+    artifacts.repo = pygit2.Repository(str(Path(temp_dir.name, ".git")))
 
-    dict = reset_test_repo(artifacts)
+    # undo anything pushed by earlier tests, so the remote matches the copy.
+    ref = artifacts.repo.head.name
+    artifacts.repo.remotes[0].push(
+        [f"+{ref}:{ref}"], callbacks=artifacts.credentials_callback
+    )
+
+    dict = template.copy()
+    for key in ("user_env_path", "group_env_path"):
+        dict[key] = Path(
+            temp_dir.name, cast(Path, template[key]).relative_to(template_path)
+        )
     dict["temp_dir"] = temp_dir
     dict["artifacts"] = artifacts
 